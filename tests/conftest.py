@@ -62,10 +62,28 @@ from app.api.rest_api import RestApi
 
 from app import version
 
+try:
+    import uvloop
+except ImportError:  # uvloop is unavailable on Windows
+    uvloop = None
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    # uvloop's get_event_loop refuses to create a loop on demand, which the stdlib
+    # policy still does for the module-level futures built during collection
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
 DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_DIR = os.path.join(DIR, '..', 'conf')
 
 
+@pytest.fixture(scope='session')
+def event_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
 @pytest.fixture(scope='session')
 def init_base_world():
     with open(os.path.join(CONFIG_DIR, 'default.yml')) as c: